@@ -4,9 +4,52 @@ import io
 import json
 import threading
 import queue
+import selectors
 import datetime
 import time
 import os
+import unittest.mock
+
+class FastTimestampWorks(unittest.TestCase):
+
+    def test_same_as_strptime(self):
+        """_fast_ts must give the same result as datetime.strptime"""
+        for ts in ['2018-12-26 18:12:19.903159', '2018-12-26 18:12:19.9', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')]:
+            self.assertEqual(unbabel_cli._fast_ts(ts), datetime.datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f').timestamp())
+
+class IngestWorks(unittest.TestCase):
+
+    def test_ingest_events(self):
+        """Only events with a duration and a timestamp within the window are kept"""
+        ts = '2018-12-26 18:12:19.903159'
+        now = unbabel_cli._fast_ts(ts) + 1
+        self.assertTupleEqual(unbabel_cli._ingest({"timestamp": ts, "duration": 20}, now, 2), (now - 1, 20))
+        self.assertIsNone(unbabel_cli._ingest({"timestamp": ts, "duration": 20}, now, 1))
+        self.assertIsNone(unbabel_cli._ingest({"timestamp": ts}, now, 2))
+        self.assertIsNone(unbabel_cli._ingest({"duration": 20}, now, 2))
+        self.assertIsNone(unbabel_cli._ingest({"timestamp": ts, "duration": "20"}, now, 2))
+        self.assertIsNone(unbabel_cli._ingest({"timestamp": ts, "duration": True}, now, 2))
+        for duration in [float('nan'), float('inf'), float('-inf')]:
+            self.assertIsNone(unbabel_cli._ingest({"timestamp": ts, "duration": duration}, now, 2))
+        self.assertIsNone(unbabel_cli._ingest(json.loads('{"timestamp": "%s", "duration": NaN}' % ts), now, 2))
+
+class DrainWorks(unittest.TestCase):
+
+    def test_drain_queues(self):
+        """_drain must return every queued item in order and leave the queue empty"""
+        for q in [queue.Queue(), getattr(queue, 'SimpleQueue', queue.Queue)()]:
+            for k in range(3):
+                q.put(k)
+            self.assertListEqual(unbabel_cli._drain(q), [0, 1, 2])
+            self.assertTrue(q.empty())
+
+class ChunkedSource:
+    """File-like object returning the given chunks one at a time, and '' afterwards"""
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def read(self, size=-1):
+        return self.chunks.pop(0) if self.chunks else ''
 
 class StreamerWorks(unittest.TestCase):
 
@@ -21,43 +64,125 @@ class StreamerWorks(unittest.TestCase):
         line = unbabel_cli.streamer(self.streaming_data_finished_line, self.close_streaming)
         self.assertEqual(next(line), json.loads('{"part1": 0, "part2": 0}'))
 
-class PublisherWorks(unittest.TestCase):
+    def test_read_line_in_parts(self):
+        """streamer must join a line that is read in several parts"""
+        source = ChunkedSource(['{"part1": 0, ', '"part2": 0}\n', '{"part3": 0}\n'])
+        line = unbabel_cli.streamer(source, self.close_streaming)
+        self.assertEqual(next(line), json.loads('{"part1": 0, "part2": 0}'))
+        self.assertEqual(next(line), json.loads('{"part3": 0}'))
+
+    def test_read_several_lines_at_once(self):
+        """streamer must split a block into lines and keep the incomplete end for later"""
+        source = ChunkedSource(['{"part1": 0}\n{"part2": 0}\n{"part3"', ': 0}\n'])
+        line = unbabel_cli.streamer(source, self.close_streaming)
+        self.assertListEqual([next(line) for k in range(3)], [{"part1": 0}, {"part2": 0}, {"part3": 0}])
+
+    def test_skip_invalid_lines(self):
+        """streamer must skip lines that are not valid json and yield None when there is nothing to read"""
+        source = ChunkedSource(['{"part1": 0}\n{"part2\n{"part3": 0}\n'])
+        line = unbabel_cli.streamer(source, self.close_streaming)
+        self.assertListEqual([next(line) for k in range(3)], [{"part1": 0}, {"part3": 0}, None])
+
+    def test_read_from_pipe(self):
+        """streamer must wait for new lines from a pipe and read them when they arrive"""
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'r') as source, open(write_fd, 'w') as sink:
+            line = unbabel_cli.streamer(source, self.close_streaming)
+            self.assertIsNone(next(line))
+            sink.write('{"part1": 0}\n{"part2"')
+            sink.flush()
+            self.assertEqual(next(line), {"part1": 0})
+            sink.write(': 0}\n')
+            sink.flush()
+            self.assertEqual(next(line), {"part2": 0})
+
+    def test_read_invalid_bytes_from_pipe(self):
+        """streamer must decode pipes with the errors setting of the file object"""
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'r', errors='replace') as source, open(write_fd, 'wb') as sink:
+            line = unbabel_cli.streamer(source, self.close_streaming)
+            sink.write(b'\xff\n{"part1": 0}\n')
+            sink.flush()
+            self.assertEqual(next(line), {"part1": 0})
+
+    def test_read_from_pipe_without_select(self):
+        """streamer must fall back to polling without blocking if the selector can not wait on the source"""
+        class FailingSelector(selectors.DefaultSelector):
+            def select(self, timeout=None):
+                raise OSError("not supported")
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'r') as source, open(write_fd, 'w') as sink:
+            sink.write('{"part1": 0}\n')
+            sink.flush()
+            with unittest.mock.patch.object(unbabel_cli.selectors, 'DefaultSelector', FailingSelector):
+                line = unbabel_cli.streamer(source, self.close_streaming)
+                self.assertEqual(next(line), {"part1": 0})
+                self.assertIsNone(next(line))
+                sink.write('{"part2": 0}\n')
+                sink.flush()
+                self.assertEqual(next(line), {"part2": 0})
+
+    def test_reader_for_source(self):
+        """Only streams are waited on with a selector, regular files and in-memory files are read directly"""
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'r') as source, open(write_fd, 'w'):
+            selector, read = unbabel_cli._selector_reader(source)
+            self.assertIsNotNone(selector)
+            selector.close()
+        with open(__file__, 'r') as source:
+            self.assertTupleEqual(unbabel_cli._selector_reader(source), (None, source.read))
+        source = io.StringIO()
+        self.assertTupleEqual(unbabel_cli._selector_reader(source), (None, source.read))
+
+class HandlerWorks(unittest.TestCase):
     def setUp(self):
         self.correct_file = 'test1.json'
         with open(self.correct_file, 'w+') as ofile:
+            ofile.write('{"timestamp": "%s", "duration": 100}\n' % (datetime.datetime.now()-datetime.timedelta(seconds=10)).strftime('%Y-%m-%d %H:%M:%S.%f'))
             ofile.write('{"timestamp": "%s", "duration": 20}\n{"timestamp": "%s", "duration": 31}\n{"timestamp": "%s", "duration": 54}\n' 
                     % ((datetime.datetime.now()-datetime.timedelta(seconds=2)).strftime('%Y-%m-%d %H:%M:%S.%f'), (datetime.datetime.now()-datetime.timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S.%f'), datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')))
+            ofile.write('{"timestamp": "%s"}\n' % datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'))
     def tearDown(self):
         if os.path.exists('test1.json'):
             os.remove('test1.json')
 
-    def test_publish_events(self):
-        """Events are published correctly"""
-        q = queue.Queue()
-        close_publisher = threading.Event()
-        thread = threading.Thread(target=unbabel_cli.publisher, args=(self.correct_file, q, close_publisher), kwargs={'window':4, 'timeout':30})
+    def run_handler(self, window):
+        qout = queue.Queue()
+        close_handler = threading.Event()
+        thread = threading.Thread(target=unbabel_cli.handler, args=(1, self.correct_file, qout, close_handler), kwargs={'window':window})
         thread.start()
-        time.sleep(0.5)
-        close_publisher.set()
+        time.sleep(1.5)
+        close_handler.set()
         thread.join()
-        messages = [q.get(timeout=1).get('duration') for k in range(3)]
-        self.assertListEqual(messages, [20, 31, 54])    
+        return qout.get(timeout=1)[1]
 
-class HandlerWorks(unittest.TestCase):
+    def test_handle_events(self):
+        """Events are handled correctly"""
+        self.assertEqual(self.run_handler(4), 35)
 
-    def test_handle_messages(self):
-        """Messages are handled correctly"""
-        qin = queue.Queue()
+    def test_old_events_are_dropped(self):
+        """Events older than the window do not count for the average"""
+        self.assertEqual(self.run_handler(2), 54)
+
+    def test_invalid_bytes_are_skipped(self):
+        """Lines with bytes which are not valid in the encoding do not stop the handler"""
+        with open(self.correct_file, 'wb') as ofile:
+            ofile.write(b'\xff\n{"timestamp": "%s", "duration": 54}\n' % datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f').encode())
+        self.assertEqual(self.run_handler(4), 54)
+
+    def test_window_empties_and_refills(self):
+        """After a quiet period longer than the window the average is None, then new events count again"""
         qout = queue.Queue()
         close_handler = threading.Event()
-        thread = threading.Thread(target=unbabel_cli.handler, args=(1, qin, qout, close_handler), kwargs={'window':4})
+        thread = threading.Thread(target=unbabel_cli.handler, args=(1, self.correct_file, qout, close_handler), kwargs={'window':1})
         thread.start()
-        qin.put({"timestamp": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), "duration": 54}, timeout=1)
-        time.sleep(0.5)
+        time.sleep(1.5)
+        with open(self.correct_file, 'a') as ofile:
+            ofile.write('{"timestamp": "%s", "duration": 10}\n' % datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'))
+        time.sleep(1)
         close_handler.set()
         thread.join()
-        output = qout.get(timeout=1)
-        self.assertEqual(json.loads(output).get('average_delivery_time'), 54)
+        self.assertListEqual([qout.get(timeout=1)[1] for k in range(2)], [None, 10])
 
 class WriterWorks(unittest.TestCase):
     def setUp(self):
@@ -72,14 +197,38 @@ class WriterWorks(unittest.TestCase):
         close_writer = threading.Event()
         thread = threading.Thread(target=unbabel_cli.writer, args=(self.correct_file, qin, close_writer))
         thread.start()
-        qin.put({"date":  datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), "average_delivery_time": 45.5})
+        qin.put((datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), 45.5))
         time.sleep(0.5)
         close_writer.set()
         thread.join()
         with open(self.correct_file, 'r') as ifile:
-            l = ifile.readline().replace("'", '"')
+            l = ifile.readline()
         self.assertEqual(json.loads(l).get("average_delivery_time"), 45.5)
 
+    def test_write_queued_messages(self):
+        """Messages already waiting in the queue are all written, in order"""
+        qin = queue.Queue()
+        for average in [0, 1.5, None]:
+            qin.put(('2018-12-26 18:11:00', average))
+        close_writer = threading.Event()
+        thread = threading.Thread(target=unbabel_cli.writer, args=(self.correct_file, qin, close_writer))
+        thread.start()
+        time.sleep(0.5)
+        close_writer.set()
+        thread.join()
+        with open(self.correct_file, 'r') as ifile:
+            result_list = [json.loads(l).get("average_delivery_time") for l in ifile.readlines()]
+        self.assertListEqual(result_list, [0, 1.5, None])
+
+class ParseArgumentsWorks(unittest.TestCase):
+
+    def test_parse_arguments(self):
+        """Arguments are parsed, invalid window and frequency values are replaced by the defaults"""
+        self.assertTupleEqual(unbabel_cli.parse_arguments(['--input_file', 'in.json', '--output_file', 'out.json', '--window_size', '4', '--frequency', '2']), 
+            ('in.json', 'out.json', 2, 4))
+        self.assertTupleEqual(unbabel_cli.parse_arguments(['--input_file', 'in.json', '--window_size', '0', '--frequency', '-1']), 
+            ('in.json', None, 60, 1))
+
 class MainWorks(unittest.TestCase):
 
     def setUp(self):
@@ -9,84 +9,264 @@ the moment.
 """
 import time
 import datetime
-import json
 import queue
 import threading
 import argparse
 import contextlib
+import collections
+import codecs
+import logging
+import math
+import os
+import selectors
+import stat
 import sys
+try:
+    #orjson is an optional, faster, drop-in replacement for json.loads
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+logger = logging.getLogger(__name__)
+
+#Output line written for every moving average computation, the date only contains digits, 
+#spaces, dashes, colons and dots so it does not need any escaping
+_OUTPUT_TEMPLATE = '{"date": "%s", "average_delivery_time": %s}'
 
 @contextlib.contextmanager
 def none_context_manager():
     """Dummy context manager, does nothing and returns None"""
     yield None
 
-def streamer(source, close_event):
+def _fast_ts(timestamp):
+    """
+    Convert a '%Y-%m-%d %H:%M:%S.%f' timestamp string to a POSIX timestamp
+
+    The format is fixed width, so the fields are sliced directly instead of going 
+    through datetime.strptime. As with strptime, the timestamp is taken to be in local time.
+
+    Parameters
+    ----------
+    timestamp: str
+        Timestamp string, e.g. '2018-12-26 18:12:19.903159'
+    Returns
+    -------
+    timestamp: float
+        POSIX timestamp
+    """
+    return datetime.datetime(
+        int(timestamp[0:4]), 
+        int(timestamp[5:7]), 
+        int(timestamp[8:10]), 
+        int(timestamp[11:13]), 
+        int(timestamp[14:16]), 
+        int(timestamp[17:19]), 
+        int(timestamp[20:26].ljust(6, '0'))
+        ).timestamp()
+
+def _drain(source_queue):
+    """
+    Take all the items currently in a queue without blocking
+
+    Parameters
+    ----------
+    source_queue: queue.Queue or queue.SimpleQueue object
+        Queue to be emptied
+    Returns
+    -------
+    items: list
+        Items removed from the queue, in the order they were put
+    """
+    #empty() is only advisory, so get until the queue says it is empty instead of asking first
+    items = []
+    try:
+        while True:
+            items.append(source_queue.get_nowait())
+    except queue.Empty:
+        pass
+    return items
+
+def _ingest(event, now, window):
+    """
+    Get the timestamp and duration of an event, if it counts for the moving average
+
+    Events without a timestamp or a finite numeric duration never count for the average, nor 
+    do events with timestamps older than the window. A NaN or infinite duration would stay in 
+    the running total after the event left the window.
+
+    Parameters
+    ----------
+    event: dict
+        Event as read from the input file
+    now: float
+        Current POSIX timestamp
+    window: int or float
+        Moving average window in seconds
+    Returns
+    -------
+    message: tuple or None
+        (timestamp, duration) tuple, None if the event does not count
+    """
+    dt = event.get('timestamp')
+    duration = event.get('duration')
+    if dt is None or not isinstance(duration, (int, float)) or isinstance(duration, bool) or not math.isfinite(duration):
+        return None
+    ts = _fast_ts(dt)
+    return (ts, duration) if now - ts < window else None
+
+def _fd_reader(source, nonblocking=False):
+    """
+    Build a function reading a file object directly from its file descriptor
+
+    Parameters
+    ----------
+    source: file object
+        Source file, opened in text mode
+    nonblocking: bool, optional
+        Switch the file descriptor to non-blocking mode, so that reads return '' instead of 
+        waiting when there is no data (default is False)
+    Returns
+    -------
+    read: function
+        Function taking the maximum number of bytes to read and returning the decoded text, 
+        if the descriptor can not be made non-blocking the source's readline() method is 
+        returned instead as a last resort
+    """
+    fd = source.fileno()
+    if nonblocking:
+        try:
+            os.set_blocking(fd, False)
+        except (AttributeError, OSError):
+            #e.g. pipes on Windows before Python 3.12, readline returns as soon as a line is complete
+            return source.readline
+    #decoding errors are handled as the file object would, e.g. errors='replace'
+    decoder = codecs.getincrementaldecoder(getattr(source, 'encoding', None) or 'utf-8')(getattr(source, 'errors', None) or 'strict')
+    def read(size):
+        try:
+            return decoder.decode(os.read(fd, size))
+        except BlockingIOError:
+            return ''
+    return read
+
+def _selector_reader(source):
+    """
+    Prepare to wait for new data on a file object with a selector
+
+    This only works for sources like pipes, FIFOs or sockets. Regular files are always 
+    reported as ready (or rejected, by epoll) and objects like io.StringIO have no file 
+    descriptor, for those no selector is returned and they are read with their read() 
+    method, which never waits for more data. Streams which can not be registered in a 
+    selector are switched to non-blocking mode and polled, since a block read would wait 
+    for a full block.
+
+    Parameters
+    ----------
+    source: file object
+        Source file, opened in text mode
+    Returns
+    -------
+    selector, read: tuple
+        A selector registered for reading the source, or None, and a function taking the 
+        maximum number of characters to read and returning the text read
+    """
+    try:
+        fd = source.fileno()
+        mode = os.fstat(fd).st_mode
+    except (AttributeError, OSError, ValueError):
+        return None, source.read
+    if not (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stat.S_ISCHR(mode)):
+        return None, source.read
+    selector = selectors.DefaultSelector()
+    try:
+        selector.register(fd, selectors.EVENT_READ)
+    except (OSError, ValueError):
+        selector.close()
+        return None, _fd_reader(source, nonblocking=True)
+    #the file object is bypassed so that a read never blocks once the selector fires
+    return selector, _fd_reader(source)
+
+def streamer(source, close_event, chunk_size=65536, timeout=0.05, wait=None):
     """
     Generator yielding new lines from a file object
 
     Loops a file object continuously and yields on each complete line terminating
     in a new line character '\n'. It is assumed that each line is a valid json object, 
-    so the output is dictionary.
+    so the output is dictionary, lines which can not be parsed are skipped. The file is 
+    read in blocks of up to chunk_size characters which are then split in lines.
+
+    When there is nothing new to read None is yielded, so that the caller can do other 
+    work while waiting for new lines. Sources like pipes are waited on with a selector for 
+    up to timeout seconds, other sources are polled every millisecond. Neither wait is longer 
+    than the time given by wait, if any. Streams which can not be waited on with a selector 
+    are switched to non-blocking mode and polled as well.
     
     Parameters
     ----------
     source: file object
-        Source file, must have a readline() method
+        Source file, must have a read() method
     close_event: threading.Event object
         Event which can be used to end the thread from an outside controlling thread
+    chunk_size: int, optional
+        Maximum number of characters read at once (default is 65536)
+    timeout: int or float, optional
+        Maximum time waiting for new data with a selector in seconds (default is 0.05)
+    wait: callable, optional
+        Function returning the time in seconds the caller can wait before it needs the control 
+        back (default is None, no limit)
     Yields
     ------
-    new_line: dict
-        Dictionary corresponding to a line
+    new_line: dict or None
+        Dictionary corresponding to a line, None if there is no new line yet
     """
-    new_line = ''
+    selector, read = _selector_reader(source)
+    #pieces of a line which is still incomplete, joined once the line ends
+    parts = []
     while not close_event.is_set():
-        line = source.readline()
-        if not line:
-            time.sleep(0.001)
-        else:
-            new_line += line
-            if line.endswith('\n'):
-                yield json.loads(new_line)
-                new_line = ''
-
-def publisher(file_name, pub_queue, close_event, window=1, timeout=30):
-    """
-    Reads lines from a streaming file and puts them in a queue for further processing
-
-    Parameters
-    ----------
-    file_name: str
-        Path of file to be streamed
-    pub_queue: queue.Queue object
-        Queue to put new lines
-    close_event: threading.Event object
-        Event which can be used to end the thread from an outside controlling thread
-    window: int, optional
-        Size of censoring window in seconds (default is 1), lines with timestamps
-        older than this values will be ignored
-    timeout: int, optional
-        Timeout for putting items in the queue in seconds (default is 30)
-    """
-    with open(file_name, 'r') as in_file:
-        streaming_generator = streamer(in_file, close_event)
-        while not close_event.is_set():
-        # for l in streamer(in_file):
+        if selector is not None:
             try:
-                l = next(streaming_generator)
-                now = time.time()
-                dt = l.get('timestamp')
-                #Timestamps older than window value are ignored
-                if dt is not None and now - datetime.datetime.strptime(dt, '%Y-%m-%d %H:%M:%S.%f').timestamp() < window:
-                    print ("Putting", l)
-                    pub_queue.put(l, timeout=timeout)
-            except Exception as e:
-                print("Error publishing: %s" % e)
+                ready = selector.select(timeout if wait is None else max(0, min(timeout, wait())))
+            except OSError:
+                #the selector can not wait on this stream after all, e.g. select on Windows only 
+                #supports sockets, so poll it without blocking instead
+                selector.close()
+                selector, read = None, _fd_reader(source, nonblocking=True)
+                ready = True
+            if not ready:
+                yield None
+                continue
+        chunk = read(chunk_size)
+        if not chunk:
+            time.sleep(0.001 if wait is None else max(0, min(0.001, wait())))
+            yield None
+            continue
+        lines = []
+        start = 0
+        end = chunk.find('\n')
+        if end >= 0 and parts:
+            parts.append(chunk[:end + 1])
+            lines.append(''.join(parts))
+            parts.clear()
+            start = end + 1
+            end = chunk.find('\n', start)
+        while end >= 0:
+            lines.append(chunk[start:end + 1])
+            start = end + 1
+            end = chunk.find('\n', start)
+        if start < len(chunk):
+            parts.append(chunk[start:])
+        for line in lines:
+            try:
+                new_line = _json.loads(line)
+            except ValueError as e:
+                logger.error("Error parsing line %r: %s", line, e)
+                continue
+            yield new_line
+    if selector is not None:
+        selector.close()
 
-def handler(delay, pub_queue, write_queue, close_event, window=1):
+def handler(delay, file_name, write_queue, close_event, window=1):
     """
-    Receives dictionaries from a queue, containing at a minimum a 'timestamp' key, 
+    Reads events from a streaming file, containing at a minimum a 'timestamp' key, 
     computes a moving average of the value given by the 'duration' key (if it exists) 
     with a given frequency and puts the output in a queue for further processing
 
@@ -98,81 +278,99 @@ def handler(delay, pub_queue, write_queue, close_event, window=1):
         frequency of moving average computation in seconds. The moving average is computed every 
         delay seconds. The first computation instant is rounded to the beggining of the next minute if 
         delay is 1 minute or more
-    pub_queue: queue.Queue object
-        new dictionaries are obtained from this queue
-    write_queue: queue.Queue object
-        put computed moving average and and respective timestamp in this queue
+    file_name: str
+        Path of file to be streamed
+    write_queue: queue.Queue or queue.SimpleQueue object
+        put computed moving average and and respective date in this queue, as a (date, average) tuple
     close_event: threading.Event object
         Event which can be used to end the thread from an outside controlling thread
     window: int or float, optional
-        Moving average window in seconds (default is 1)
+        Moving average window in seconds (default is 1), events with timestamps
+        older than this value when they are read will be ignored
     """
     next_time = datetime.datetime.now() + datetime.timedelta(seconds=delay)
     if delay >= 60:
-        next_time = next_time.replace(microsecond=0, second=0).timestamp()
-    else:
-        next_time = next_time.timestamp()
-    messages = []
-    print("Next time ", datetime.datetime.fromtimestamp(next_time))
-    while not close_event.is_set():
-        sleeping_time = next_time - time.time()
-        print ("Sleeping for %s seconds..." % sleeping_time)
-        time.sleep(max(0, sleeping_time))
-        print("Finished sleeping")
-        try:
-            now = time.time()
-            while not pub_queue.empty():
-                messages.append(pub_queue.get(block=False))
-            #Where the magic happens: filter all current messages to have only the ones within the window
-            #then grab the durations, note that a duration of zero is assumed if the key is not found
-            #It is assumed that the event name is always "translation_delivered", but this would be the 
-            # place to filter by event_name if required
-            messages = [x for x in messages if now - \
-                datetime.datetime.strptime(x.get('timestamp'), '%Y-%m-%d %H:%M:%S.%f').timestamp() < window]
-            durations = [x.get('duration') for x in messages if x.get('duration') is not None]
-            print("Durations: ", durations)
-            if len(durations) > 0:
-                average = sum(durations) / len(durations)
-            else:
-                average = None
-            msg = json.dumps(
-                {
-                    "date": datetime.datetime.fromtimestamp(now).isoformat(' '), 
-                    "average_delivery_time": average
-                    }
-            )
-            write_queue.put(msg, timeout=window)
-        except Exception as e:
-            print("Error handling: %s" % e)
-        #next time is adjusted to avoid drifting and to jump multiples of delay if processing took to long
-        next_time += (time.time() - next_time) // delay * delay + delay
+        next_time = next_time.replace(microsecond=0, second=0)
+    logger.debug("Next time %s", next_time)
+    #the computation instants are scheduled on the monotonic clock, so that they are not affected 
+    #by changes to the system time, the wall clock is only used for the output dates and the window
+    next_time = time.monotonic() + (next_time.timestamp() - time.time())
+    #(timestamp, duration) tuples, in arrival order, which is assumed to be timestamp order
+    messages = collections.deque()
+    #running sum of the durations in the window, updated as messages come in and out
+    total = 0
+    #invalid bytes are replaced rather than raised from the reads, which would stop the handler, 
+    #the line they are in is then skipped if it is no longer valid json
+    with open(file_name, 'r', errors='replace') as in_file:
+        for event in streamer(in_file, close_event, wait=lambda: next_time - time.monotonic()):
+            if event is not None:
+                try:
+                    message = _ingest(event, time.time(), window)
+                    if message is not None:
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("Adding %s", event)
+                        total += message[1]
+                        messages.append(message)
+                except Exception as e:
+                    logger.error("Error reading event: %s", e)
+            if time.monotonic() < next_time:
+                continue
+            try:
+                now = time.time()
+                #Where the magic happens: drop the messages that fell out of the window, since they are
+                #ordered only the oldest ones need to be checked, and update the running sum of the durations
+                #It is assumed that the event name is always "translation_delivered", but this would be the 
+                # place to filter by event_name if required
+                while messages and now - messages[0][0] >= window:
+                    total -= messages.popleft()[1]
+                if messages:
+                    average = total / len(messages)
+                else:
+                    #avoids accumulating floating point error once the window is empty
+                    total = 0
+                    average = None
+                logger.debug("Messages in window: %s, total %s", len(messages), total)
+                write_queue.put((datetime.datetime.fromtimestamp(now).isoformat(' '), average), timeout=window)
+            except Exception as e:
+                logger.error("Error handling: %s", e)
+            #next time is adjusted to avoid drifting and to jump multiples of delay if processing took to long
+            next_time += (time.monotonic() - next_time) // delay * delay + delay
+            logger.debug("Next time in %s seconds", next_time - time.monotonic())
 
 def writer(file_name, write_queue, close_event):
     """
-    Receive dictionaries from a queue and write them to a file or the stdout
+    Receive (date, average) tuples from a queue and write them as json to a file or the stdout
+
+    All the messages waiting in the queue are written together and the output is 
+    flushed once for each of these batches.
 
     Parameters
     ----------
     file_name: str or None
         Path of output file. If None, the stdout will be used instead
-    write_queue: queue.Queue object
-        receive dictionaries from this queue
+    write_queue: queue.Queue or queue.SimpleQueue object
+        receive (date, average) tuples from this queue, average can be None
     close_event: threading.Event object
         Event which can be used to end the thread from an outside controlling thread
     """
-    with open(file_name, 'w+') if file_name is not None else none_context_manager() as o_file:
+    with open(file_name, 'w+', buffering=65536) if file_name is not None else none_context_manager() as o_file:
+        if o_file is None:
+            o_file = sys.stdout
         while not close_event.is_set():
             try:
-                msg =write_queue.get(timeout=0.1)
-                print(str(msg), file=o_file, flush=True)
+                msgs = [write_queue.get(timeout=0.1)]
+                msgs.extend(_drain(write_queue))
+                o_file.write('\n'.join(_OUTPUT_TEMPLATE % (date, 'null' if average is None else average) for date, average in msgs))
+                o_file.write('\n')
+                o_file.flush()
             except queue.Empty:
                 pass
             except Exception as e:
-                print("Error writing: %s" % e)
+                logger.error("Error writing: %s", e)
 
 def main(args, close_event=None):
     """
-    Main function: launches the three required threads (publisher, handler and writer)
+    Main function: launches the two required threads (handler and writer)
 
     Parse required arguments from the command line
 
@@ -186,24 +384,34 @@ def main(args, close_event=None):
     try:
         in_file, out_file, delay, window = parse_arguments(args)
     except Exception as e:
-        print ("Could not obtain arguments: %s" % e)
+        logger.error("Could not obtain arguments: %s", e)
         raise
-    pub_queue = queue.Queue()
-    write_queue = queue.Queue()
+    #the queue has a single producer and a single consumer and is never bounded, 
+    #so the lighter SimpleQueue is enough, it is only available from Python 3.7
+    write_queue = getattr(queue, 'SimpleQueue', queue.Queue)()
     if close_event is None:
         close_event = threading.Event()
-    pub_thread = threading.Thread(target=publisher, args=(in_file, pub_queue, close_event), kwargs={'window': window}, daemon=True)
-    handler_thread = threading.Thread(target=handler, args=(delay, pub_queue, write_queue, close_event), kwargs={'window': window}, daemon=True)
+    handler_thread = threading.Thread(target=handler, args=(delay, in_file, write_queue, close_event), kwargs={'window': window}, daemon=True)
     writer_thread = threading.Thread(target=writer, args=(out_file, write_queue, close_event), daemon=True)
-    pub_thread.start()
     handler_thread.start()
     writer_thread.start()
     while not close_event.is_set():
         close_event.wait(10)
     writer_thread.join()
-    pub_thread.join()
     handler_thread.join()
 
+def _build_parser():
+    """Build the command line argument parser, see parse_arguments"""
+    arg_parser = argparse.ArgumentParser(description="Reads events from a file stream and writes aggregated statistics to a file")
+    arg_parser.add_argument('--input_file', required=True, help='Path to the input file', metavar='input file', dest='in_file')
+    arg_parser.add_argument('--output_file', default=None, required=False, help='Path to the input file, if not given the output is sent to to stdout [default: None]', metavar='output file', dest='out_file')
+    arg_parser.add_argument('--window_size', default=1, required=False, help='Moving average window size in seconds, must be an integer >= 1, the default will be used otherwise [default: 1]', type=int, metavar='Window size', dest='window')
+    arg_parser.add_argument('--frequency', default=60, required=False, help='Frequency of moving average calculation in seconds, must be an integer >=1 [default: 60]', type=int, metavar='Frequency', dest='frequency')
+    return arg_parser
+
+#the parser does not keep any state between calls, so it is built only once
+_ARG_PARSER = _build_parser()
+
 def parse_arguments(cl_args):
     """
     Parse arguments from the command line
@@ -220,14 +428,9 @@ def parse_arguments(cl_args):
     args.in_file, args.out_file, frequency, window: tuple
         arguments as parsed from the command line or defaults when required
     """
-    arg_parser = argparse.ArgumentParser(description="Reads events from a file stream and writes aggregated statistics to a file")
-    arg_parser.add_argument('--input_file', required=True, help='Path to the input file', metavar='input file', dest='in_file')
-    arg_parser.add_argument('--output_file', default=None, required=False, help='Path to the input file, if not given the output is sent to to stdout [default: None]', metavar='output file', dest='out_file')
-    arg_parser.add_argument('--window_size', default=1, required=False, help='Moving average window size in seconds, must be an integer >= 1, the default will be used otherwise [default: 1]', type=int, metavar='Window size', dest='window')
-    arg_parser.add_argument('--frequency', default=60, required=False, help='Frequency of moving average calculation in seconds, must be an integer >=1 [default: 60]', type=int, metavar='Frequency', dest='frequency')
-    args = arg_parser.parse_args(cl_args)
-    window = args.window if args.window > 0 else arg_parser.get_default('window')
-    frequency = args.frequency if args.frequency > 0 else arg_parser.get_default('frequency')
+    args = _ARG_PARSER.parse_args(cl_args)
+    window = args.window if args.window > 0 else _ARG_PARSER.get_default('window')
+    frequency = args.frequency if args.frequency > 0 else _ARG_PARSER.get_default('frequency')
     return args.in_file, args.out_file, frequency, window
 
 if __name__ == "__main__":